@@ -1,26 +1,725 @@
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, request, jsonify, send_file, send_from_directory, render_template
 import os
 import uuid
 import io
+import shutil
+import subprocess
+import sys
 import zipfile
 import tempfile
+import threading
+import time
+import multiprocessing
+import mimetypes
+import logging
+import re
+import functools
+import base64
+import glob
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import NotFound
+from flask_caching import Cache
 import imageio
 import numpy as np
+import pillow_heif
+from PIL import Image
+
+# Conversion backend: 'auto' takes the external-tool shortcuts and libvips where
+# available, falling back to pillow_heif/imageio. 'vips' and 'imageio' pin one
+# pipeline so the two can be compared: 'vips' decodes and encodes everything
+# with libvips and fails rather than fall back, while 'imageio' uses only
+# pillow_heif and imageio, never loading libvips, TurboJPEG or the ffmpeg,
+# sips and mozjpeg helpers
+IMG_BACKEND = os.environ.get('IMG_BACKEND', 'auto')
+if IMG_BACKEND not in ('auto', 'vips', 'imageio'):
+    raise ValueError(f"IMG_BACKEND must be 'auto', 'vips' or 'imageio', not {IMG_BACKEND!r}")
+
+if IMG_BACKEND == 'imageio':
+    pyvips = None
+else:
+    try:
+        import pyvips
+    except (ImportError, OSError):
+        # pyvips needs the libvips shared library at runtime; fall back to imageio without it
+        if IMG_BACKEND == 'vips':
+            raise
+        pyvips = None
+
+if IMG_BACKEND == 'imageio':
+    turbo_jpeg = None
+else:
+    try:
+        from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY, TJSAMP_420, TJSAMP_GRAY
+        turbo_jpeg = TurboJPEG()
+    except (ImportError, OSError, RuntimeError):
+        # PyTurboJPEG needs the libturbojpeg shared library at runtime; fall back to imageio without it
+        turbo_jpeg = None
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
 
-# Store session data in memory (in production, use a proper database)
-sessions = {}
+# Session metadata lives in a shared cache so every server worker sees the
+# same sessions; the files themselves stay in the uploads directory. Sessions
+# expire after 15 minutes. The default filesystem cache holds at most
+# SESSION_LIMIT of them; set REDIS_URL to share sessions across hosts instead.
+SESSION_TIMEOUT = 900
+SESSION_LIMIT = 1024
+if os.environ.get('REDIS_URL'):
+    session_cache_config = {
+        'CACHE_TYPE': 'RedisCache',
+        'CACHE_REDIS_URL': os.environ['REDIS_URL'],
+        'CACHE_KEY_PREFIX': 'heic-session:'
+    }
+else:
+    session_cache_config = {
+        'CACHE_TYPE': 'FileSystemCache',
+        'CACHE_DIR': os.path.join(tempfile.gettempdir(), 'heic-converter-sessions'),
+        'CACHE_THRESHOLD': SESSION_LIMIT
+    }
+session_cache_config['CACHE_DEFAULT_TIMEOUT'] = SESSION_TIMEOUT
+sessions = Cache(app, config=session_cache_config)
+
+# How often the janitor looks for upload files whose session has expired
+JANITOR_INTERVAL = 60
 
 # Ensure uploads directory exists
 os.makedirs('uploads', exist_ok=True)
 
+# Internal nginx location mapped onto the uploads directory. When set, downloads
+# are answered with an X-Accel-Redirect header and nginx sends the file itself
+ACCEL_REDIRECT_PREFIX = os.environ.get('ACCEL_REDIRECT_PREFIX')
+
+# Accepted upload extensions
+ALLOWED_EXTENSIONS = {'.heic', '.heif', '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
+
+# Chunk size used when streaming upload bodies to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Extensions decoded with pillow_heif rather than imageio
+HEIC_EXTENSIONS = ('.heic', '.heif')
+
+# Output formats offered by the frontend and the extension used for each
+OUTPUT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+
+# Encoder quality used when the client does not ask for one
+DEFAULT_QUALITY = 90
+
+# libvips save suffixes; strip drops EXIF/XMP/ICC in the same encode pass.
+# JPEG skips the extra Huffman-optimisation pass and forces 4:2:0 chroma
+# subsampling, which libvips would otherwise disable at Q >= 90. PNG uses
+# zlib level 6: level 9 costs several times the CPU for ~1-2% smaller files.
+# WebP is pinned to encoder effort 4; 6 is several times slower for ~1-3%.
+VIPS_SAVE_SUFFIXES = {
+    'jpeg': '.jpg[Q={quality},optimize_coding=false,interlace=false,subsample_mode=on,strip={strip}]',
+    'png': '.png[compression=6,strip={strip}]',
+    'webp': '.webp[Q={quality},effort=4,strip={strip}]',
+}
+
+# An 8x8 HEVC-coded HEIC. libvips builds whose libheif only has the AV1
+# decoder (pyvips-binary, for one) still list heifload, so check that this
+# one actually decodes before sending HEIC to libvips
+VIPS_HEIC_PROBE = base64.b64decode(
+    'AAAAHGZ0eXBoZWljAAAAAG1pZjFoZWljbWlhZgAAAXxtZXRhAAAAAAAAACFoZGxyAAAAAAAAAABwaWN0'
+    'AAAAAAAAAAAAAAAAAAAAACJpbG9jAAAAAERAAAEAAQAAAAABoAABAAAAAAAAABwAAAAjaWluZgAAAAAA'
+    'AQAAABVpbmZlAgAAAAABAABodmMxAAAAAA5waXRtAAAAAAABAAAA/GlwcnAAAADcaXBjbwAAAHVodmND'
+    'AQNwAAAAkAAAAAAAHvAA/P34+AAADwNgAAEAGEABDAH//wNwAAADAJAAAAMAAAMAHroCQGEAAQApQgEB'
+    'A3AAAAMAkAAAAwAAAwAeoCCBBZbqrprm4CGgwIAAAAyAAAADAIRiAAEABkQBwXPBiQAAABNjb2xybmNs'
+    'eAABAA0ABoAAAAAUaXNwZQAAAAAAAABAAAAAQAAAAChjbGFwAAAACAAAAAEAAAAIAAAAAf///8gAAAAC'
+    '////yAAAAAIAAAAQcGl4aQAAAAADCAgIAAAAGGlwbWEAAAAAAAAAAQABBYECAwWEAAAAJG1kYXQAAAAY'
+    'KAGvBVI43PrTmh2gsBAHaKP0hiCSoPOA'
+)
+
+def _probe_vips_heif():
+    if pyvips is None or pyvips.type_find('VipsForeign', 'heifload') == 0:
+        return False
+    try:
+        # Loading is lazy; avg() makes libheif decode the pixels
+        pyvips.Image.new_from_buffer(VIPS_HEIC_PROBE, '').avg()
+    except pyvips.Error:
+        return False
+    return True
+
+VIPS_HAS_HEIF = _probe_vips_heif()
+
+# imageio format name, whether it takes a quality setting, and writer options.
+# imageio's Pillow plugin hands the options to Pillow unchanged. They pin what
+# the libvips suffixes above ask for, which are also Pillow's defaults:
+# baseline 4:2:0 JPEG without the optimisation pass, PNG at zlib level 6 and
+# WebP at method 4.
+IMAGEIO_ENCODERS = {
+    'jpeg': ('JPEG', True, {'progressive': False, 'optimize': False, 'subsampling': '4:2:0'}),
+    'png': ('PNG', False, {'compress_level': 6}),
+    'webp': ('WEBP', True, {'method': 4}),
+}
+
+# libheif's command-line converter handles plain HEIC -> JPEG entirely in C
+HEIF_CONVERT = shutil.which('heif-convert')
+
+# jpegtran rewrites a JPEG without its metadata segments, leaving the DCT data untouched
+JPEGTRAN = shutil.which('jpegtran')
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+# EXIF orientation tag. Outputs are written upright, because the tag is lost
+# whenever metadata is stripped or the image goes through the array path
+EXIF_ORIENTATION = 0x0112
+
+# Array transforms that bring each EXIF orientation upright, as ImageOps.exif_transpose does
+EXIF_TRANSPOSES = {
+    2: lambda a: a[:, ::-1],
+    3: lambda a: a[::-1, ::-1],
+    4: lambda a: a[::-1],
+    5: lambda a: a.swapaxes(0, 1),
+    6: lambda a: np.rot90(a, -1),
+    7: lambda a: a.swapaxes(0, 1)[::-1, ::-1],
+    8: lambda a: np.rot90(a),
+}
+
+# The same transforms done losslessly by jpegtran
+JPEGTRAN_TRANSFORMS = {
+    2: ['-flip', 'horizontal'],
+    3: ['-rotate', '180'],
+    4: ['-flip', 'vertical'],
+    5: ['-transpose'],
+    6: ['-rotate', '90'],
+    7: ['-transverse'],
+    8: ['-rotate', '270'],
+}
+
+def _exif_orientation(source):
+    """EXIF orientation of an image path or file object; 1 (upright) when it has none."""
+    try:
+        with Image.open(source) as image:
+            return image.getexif().get(EXIF_ORIENTATION, 1)
+    except OSError:
+        return 1
+
+def _apply_orientation(img_array, orientation):
+    transpose = EXIF_TRANSPOSES.get(orientation)
+    return transpose(img_array) if transpose else img_array
+
+# mozjpeg's cjpeg (trellis quantisation, progressive scans) writes JPEGs
+# 20-30% smaller than stock libjpeg at the same quality, but takes several
+# times the CPU, so it is opt-in with USE_MOZJPEG, and only in the auto
+# backend, since the pinned ones encode with their own libraries. Plain
+# libjpeg builds ship a cjpeg too, so only use one that identifies as mozjpeg
+CJPEG = shutil.which('cjpeg')
+
+def _probe_mozjpeg():
+    if os.environ.get('USE_MOZJPEG', '').lower() not in ('1', 'true', 'yes'):
+        return False
+    if not CJPEG or IMG_BACKEND != 'auto':
+        return False
+    try:
+        result = subprocess.run([CJPEG, '-version'], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return 'mozjpeg' in (result.stdout + result.stderr).lower()
+
+MOZJPEG = _probe_mozjpeg()
+
+def _encode_with_cjpeg(pixels, width, height, bands, quality):
+    """Encode packed 8-bit gray or RGB ``pixels`` with mozjpeg and return the JPEG bytes."""
+    # cjpeg reads a binary PGM (gray) or PPM (RGB) from stdin and writes the JPEG to stdout
+    header = b'%s\n%d %d\n255\n' % (b'P5' if bands == 1 else b'P6', width, height)
+    result = subprocess.run(
+        [CJPEG, '-quality', str(quality), '-progressive', '-optimize'],
+        input=header + pixels, check=True, capture_output=True, timeout=_time_left()
+    )
+    return result.stdout
+
+# ffmpeg can hand HEVC decoding to fixed-function hardware (NVDEC, VAAPI,
+# VideoToolbox). The methods a build lists say nothing about which devices
+# exist, and ffmpeg only reads HEIC from 7.0 on, so this path is opt-in:
+# set FFMPEG_HWACCEL to the method to use, e.g. vaapi, cuda or videotoolbox
+FFMPEG = shutil.which('ffmpeg')
+
+def _probe_ffmpeg_hwaccel():
+    method = os.environ.get('FFMPEG_HWACCEL')
+    if not method or not FFMPEG or IMG_BACKEND == 'imageio':
+        return None
+    try:
+        result = subprocess.run([FFMPEG, '-hide_banner', '-hwaccels'], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    # First line is the "Hardware acceleration methods:" header
+    if method not in result.stdout.split()[3:]:
+        app.logger.warning("ffmpeg has no %s hardware acceleration; decoding HEIC in software", method)
+        return None
+    return method
+
+FFMPEG_HWACCEL = _probe_ffmpeg_hwaccel()
+
+# Header of the binary PPM ffmpeg writes; the pixel data follows a single whitespace byte
+PPM_HEADER = re.compile(rb'P6\s+(\d+)\s+(\d+)\s+255\s')
+
+def _decode_with_ffmpeg(file_path, size):
+    """Decode the primary HEIC image to an RGB array with ffmpeg's hardware-accelerated decoder."""
+    result = subprocess.run(
+        [FFMPEG, '-v', 'error', '-hwaccel', FFMPEG_HWACCEL, '-i', file_path,
+         '-frames:v', '1', '-f', 'image2pipe', '-c:v', 'ppm', '-'],
+        check=True, capture_output=True, timeout=_time_left()
+    )
+    header = PPM_HEADER.match(result.stdout)
+    if header is None:
+        raise ValueError("ffmpeg did not return a PPM image")
+    width, height = int(header.group(1)), int(header.group(2))
+    # ffmpeg may see only a single tile of a grid image, or rotate differently
+    # from libheif; only accept the picture pillow_heif would have produced
+    if (width, height) != tuple(size):
+        raise ValueError(f"ffmpeg decoded {width}x{height}, expected {size[0]}x{size[1]}")
+    return np.frombuffer(result.stdout, dtype=np.uint8, offset=header.end()).reshape(height, width, 3)
+
+def _decode_heic_ffmpeg(file_path, heif_file):
+    if heif_file.has_alpha:
+        raise ValueError("ffmpeg decode path is RGB only")
+    return _decode_with_ffmpeg(file_path, heif_file.size)
+
+def _decode_heic_pillow_heif(file_path, heif_file):
+    # pillow_heif decodes into a buffer numpy can view without copying
+    return np.asarray(heif_file)
+
+def _decode_heic_sips(file_path, heif_file):
+    # macOS' built-in converter, for files libheif cannot decode
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        png_path = os.path.join(tmp_dir, 'decoded.png')
+        subprocess.run(
+            ['sips', '-s', 'format', 'png', file_path, '--out', png_path],
+            check=True, capture_output=True, timeout=_time_left()
+        )
+        return imageio.imread(png_path)
+
+# HEIC decoders in order of preference, limited to those this host can run
+HEIC_DECODERS = []
+if FFMPEG_HWACCEL:
+    HEIC_DECODERS.append(_decode_heic_ffmpeg)
+HEIC_DECODERS.append(_decode_heic_pillow_heif)
+if sys.platform == 'darwin' and shutil.which('sips') and IMG_BACKEND != 'imageio':
+    HEIC_DECODERS.append(_decode_heic_sips)
+
+def _use_vips(is_heic):
+    """Whether a conversion goes through libvips; with IMG_BACKEND=vips anything else is an error."""
+    if IMG_BACKEND == 'vips' and is_heic and not VIPS_HAS_HEIF:
+        raise RuntimeError("IMG_BACKEND is vips, but this libvips build cannot decode HEIC")
+    return pyvips is not None and (VIPS_HAS_HEIF or not is_heic)
+
+def _open_with_vips(source, max_dimension):
+    """Open an image path or bytes with libvips, upright and with alpha flattened onto white."""
+    from_buffer = isinstance(source, bytes)
+    if max_dimension:
+        # thumbnail shrinks on load where the format allows (JPEG DCT scaling)
+        thumbnail = pyvips.Image.thumbnail_buffer if from_buffer else pyvips.Image.thumbnail
+        image = thumbnail(source, max_dimension, height=max_dimension, size='down')
+    else:
+        if from_buffer:
+            load = functools.partial(pyvips.Image.new_from_buffer, source, '')
+        else:
+            load = functools.partial(pyvips.Image.new_from_file, source)
+        image = load(access='sequential')
+        if image.get_typeof('orientation') and image.get('orientation') not in (0, 1):
+            # Rotating needs the whole image, so reopen it for random access
+            image = load().autorot()
+    if image.hasalpha():
+        # Flatten onto white to match the imageio RGBA handling
+        image = image.flatten(background=255)
+    return image
+
+def _encode_vips_with_cjpeg(image, quality):
+    image = image.colourspace('b-w' if image.bands == 1 else 'srgb').cast('uchar')
+    return _encode_with_cjpeg(image.write_to_memory(), image.width, image.height, image.bands, quality)
+
+def _convert_with_vips(file_path, converted_path, output_format, quality, strip_exif, max_dimension):
+    """Decode and re-encode through libvips' streaming pipeline into ``converted_path``."""
+    image = _open_with_vips(file_path, max_dimension)
+    if output_format == 'jpeg' and strip_exif and MOZJPEG:
+        # cjpeg never copies metadata, so it only stands in when stripping anyway
+        jpeg_bytes = _encode_vips_with_cjpeg(image, quality)
+        with open(converted_path, 'wb') as f:
+            f.write(jpeg_bytes)
+        return
+    suffix = VIPS_SAVE_SUFFIXES[output_format].format(
+        quality=quality,
+        strip='true' if strip_exif else 'false'
+    )
+    image.write_to_target(pyvips.Target.new_to_file(converted_path), suffix)
+
+def _decode_jpeg_scaled(file_path, max_dimension):
+    """Decode a JPEG with libjpeg-turbo's DCT scaling to the smallest size still covering ``max_dimension``.
+
+    Returns None when the JPEG already fits, so that it is decoded at its own size.
+    """
+    with open(file_path, 'rb') as f:
+        jpeg_buf = f.read()
+    width, height = turbo_jpeg.decode_header(jpeg_buf)[:2]
+    longest = max(width, height)
+    if longest <= max_dimension:
+        return None
+    # libjpeg-turbo also offers factors above 1 (9/8 up to 2/1); never decode larger.
+    # Scaled sizes round up, as libjpeg-turbo's TJSCALED does
+    factor = min(
+        (f for f in turbo_jpeg.scaling_factors
+         if f[0] <= f[1] and -(-longest * f[0] // f[1]) >= max_dimension),
+        key=lambda f: f[0] / f[1],
+        default=(1, 1)
+    )
+    return turbo_jpeg.decode(jpeg_buf, pixel_format=TJPF_RGB, scaling_factor=factor)
+
+def _do_convert(file_path, converted_path, output_format, quality, strip_exif, max_dimension=None):
+    """Convert ``file_path`` into ``converted_path`` and return the output size in bytes.
+
+    Runs in a worker process, so it only takes plain paths and options.
+    ``quality`` is None when the client left it to DEFAULT_QUALITY.
+    ``max_dimension`` bounds the longer side of the output; smaller images are left as is.
+    """
+    # Encode under a unique name and move it into place, so that a retried or
+    # doubled conversion of the session never truncates a file being served.
+    # The name keeps the session prefix for the janitor and the extension for heif-convert
+    root, ext = os.path.splitext(converted_path)
+    tmp_path = f'{root}.{uuid.uuid4().hex}{ext}'
+    try:
+        file_size = _convert_to_path(file_path, tmp_path, output_format, quality, strip_exif, max_dimension)
+        os.replace(tmp_path, converted_path)
+        return file_size
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _convert_to_path(file_path, converted_path, output_format, quality, strip_exif, max_dimension):
+    app.logger.debug("Attempting to open file: %s", file_path)
+    # The arguments are evaluated eagerly, so only pay for the stat calls when they get logged
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("File exists: %s", os.path.exists(file_path))
+        app.logger.debug("File size: %d bytes", os.path.getsize(file_path))
+    
+    is_heic = file_path.lower().endswith(HEIC_EXTENSIONS)
+    
+    # jpegtran keeps the source's own quality, so it only stands in when the client didn't ask for one
+    keep_quality = quality is None
+    if keep_quality:
+        quality = DEFAULT_QUALITY
+    
+    # Common case: HEIC -> JPEG keeping metadata, which heif-convert does natively
+    if (IMG_BACKEND == 'auto' and HEIF_CONVERT and is_heic and output_format == 'jpeg'
+            and not strip_exif and not max_dimension):
+        try:
+            subprocess.run(
+                [HEIF_CONVERT, '-q', str(quality), file_path, converted_path],
+                check=True, capture_output=True, timeout=_time_left()
+            )
+            # converted_path is a fresh temporary name, so only heif-convert can have
+            # created it; files with several top-level images come out as name-1,
+            # name-2, ... instead, which are discarded in favour of the fallback
+            if os.path.exists(converted_path):
+                file_size = os.path.getsize(converted_path)
+                app.logger.debug("Converted with heif-convert: %d bytes", file_size)
+                return file_size
+            root, ext = os.path.splitext(converted_path)
+            for numbered_path in glob.glob(f'{glob.escape(root)}-*{ext}'):
+                os.remove(numbered_path)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+            app.logger.warning("heif-convert failed, falling back: %s", e)
+    
+    # JPEG -> JPEG with metadata stripped: drop the markers losslessly instead of
+    # re-encoding, applying the EXIF orientation with a lossless transform
+    if (IMG_BACKEND == 'auto' and JPEGTRAN and strip_exif and output_format == 'jpeg' and keep_quality
+            and not max_dimension and file_path.lower().endswith(JPEG_EXTENSIONS)):
+        transform = JPEGTRAN_TRANSFORMS.get(_exif_orientation(file_path), [])
+        try:
+            # -perfect fails on sizes that are not whole MCUs instead of leaving the edge blocks untransformed
+            subprocess.run(
+                [JPEGTRAN, '-copy', 'none', '-optimize'] + (transform + ['-perfect'] if transform else [])
+                + ['-outfile', converted_path, file_path],
+                check=True, capture_output=True, timeout=_time_left()
+            )
+            file_size = os.path.getsize(converted_path)
+            app.logger.debug("Stripped metadata with jpegtran: %d bytes", file_size)
+            return file_size
+        except (subprocess.SubprocessError, OSError) as e:
+            app.logger.warning("jpegtran failed, falling back: %s", e)
+    
+    if _use_vips(is_heic):
+        try:
+            _convert_with_vips(file_path, converted_path, output_format, quality, strip_exif, max_dimension)
+            file_size = os.path.getsize(converted_path)
+            app.logger.debug("Converted with libvips: %d bytes", file_size)
+            return file_size
+        except (pyvips.Error, subprocess.SubprocessError, OSError) as e:
+            if IMG_BACKEND == 'vips':
+                raise
+            app.logger.warning("libvips conversion failed, falling back to pillow_heif/imageio: %s", e)
+    
+    if is_heic:
+        # open_heif only parses the container; pixels are decoded on first access
+        heif_file = pillow_heif.open_heif(file_path, convert_hdr_to_8bit=True, bgr_mode=False)
+        for decode in HEIC_DECODERS:
+            try:
+                img_array = decode(file_path, heif_file)
+                break
+            except (subprocess.SubprocessError, OSError, ValueError, RuntimeError) as e:
+                if decode is HEIC_DECODERS[-1]:
+                    raise
+                app.logger.warning("%s failed, trying the next HEIC decoder: %s", decode.__name__, e)
+        app.logger.debug("Decoded HEIC image with %s: shape: %s, dtype: %s", decode.__name__, img_array.shape, img_array.dtype)
+    else:
+        img_array = None
+        # Downscaling JPEGs can skip most of the IDCT work
+        if max_dimension and turbo_jpeg is not None and file_path.lower().endswith(JPEG_EXTENSIONS):
+            try:
+                img_array = _decode_jpeg_scaled(file_path, max_dimension)
+                if img_array is not None:
+                    app.logger.debug("Decoded JPEG with DCT scaling: shape: %s", img_array.shape)
+            except OSError as e:
+                app.logger.warning("Scaled JPEG decode failed, falling back to imageio: %s", e)
+        if img_array is None:
+            img_array = imageio.imread(file_path)
+            app.logger.debug("Opened image with imageio: shape: %s, dtype: %s", img_array.shape, img_array.dtype)
+        # Neither decoder applies the EXIF orientation; the libvips path does, via thumbnail/autorot
+        img_array = _apply_orientation(img_array, _exif_orientation(file_path))
+    
+    img_array = _prepare_array(img_array, max_dimension)
+    
+    # Encoders write straight into the converted file, with no intermediate buffer
+    with open(converted_path, 'wb') as f:
+        _encode_array(img_array, f, output_format, quality)
+        return f.tell()
+
+def _convert_bytes(data, filename, output_format, quality, max_dimension=None):
+    """Convert an in-memory upload and return the encoded output.
+
+    The one-shot counterpart of ``_do_convert``: the image is decoded from and
+    encoded to memory, so nothing is written to the uploads directory.
+    Metadata is always dropped, as on the array path.
+    """
+    is_heic = filename.lower().endswith(HEIC_EXTENSIONS)
+    if _use_vips(is_heic):
+        try:
+            image = _open_with_vips(data, max_dimension)
+            if output_format == 'jpeg' and MOZJPEG:
+                return _encode_vips_with_cjpeg(image, quality)
+            return image.write_to_buffer(VIPS_SAVE_SUFFIXES[output_format].format(quality=quality, strip='true'))
+        except (pyvips.Error, subprocess.SubprocessError, OSError) as e:
+            if IMG_BACKEND == 'vips':
+                raise
+            app.logger.warning("libvips conversion failed, falling back to pillow_heif/imageio: %s", e)
+    
+    if is_heic:
+        heif_file = pillow_heif.open_heif(data, convert_hdr_to_8bit=True, bgr_mode=False)
+        img_array = np.asarray(heif_file)
+    else:
+        img_array = _apply_orientation(imageio.imread(data), _exif_orientation(io.BytesIO(data)))
+    app.logger.debug("Decoded upload in memory: shape: %s, dtype: %s", img_array.shape, img_array.dtype)
+    
+    output = io.BytesIO()
+    _encode_array(_prepare_array(img_array, max_dimension), output, output_format, quality)
+    return output.getvalue()
+
+def _prepare_array(img_array, max_dimension):
+    """Reduce a decoded image array to uint8, flatten alpha onto white and apply ``max_dimension``."""
+    # The encoders and the alpha blend below all take 8-bit samples, but imageio
+    # returns 16-bit grayscale PNG/TIFF as uint16 and 1-bit images as bool
+    if img_array.dtype == np.uint16:
+        img_array = (img_array >> 8).astype(np.uint8)
+    elif img_array.dtype == np.bool_:
+        img_array = img_array.astype(np.uint8) * 255
+    elif img_array.dtype != np.uint8:
+        raise ValueError(f"Unsupported sample type: {img_array.dtype}")
+
+    # Drop alpha if necessary; grayscale stays single-channel, which every encoder accepts
+    if img_array.ndim == 3 and img_array.shape[2] in (2, 4):
+        # RGBA / gray+alpha to RGB / gray with white background
+        # Integer blend in uint16 (max 255*255 + 127 fits) instead of float64 temporaries
+        alpha = img_array[:, :, -1:].astype(np.uint16)
+        color = img_array[:, :, :-1].astype(np.uint16)
+        img_array = ((color * alpha + 255 * (255 - alpha) + 127) // 255).astype(np.uint8)
+        app.logger.debug("Flattened alpha channel onto white")
+    if img_array.ndim == 3 and img_array.shape[2] == 1:
+        img_array = img_array[:, :, 0]
+    if max_dimension and max(img_array.shape[:2]) > max_dimension:
+        image = Image.fromarray(img_array)
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        img_array = np.asarray(image)
+        app.logger.debug("Resized to %dx%d", image.width, image.height)
+    return img_array
+
+def _encode_array(img_array, f, output_format, quality):
+    """Encode a uint8 gray or RGB array into the binary file object ``f``."""
+    is_gray = img_array.ndim == 2
+    
+    if output_format == 'jpeg' and MOZJPEG:
+        height, width = img_array.shape[:2]
+        try:
+            f.write(_encode_with_cjpeg(img_array.tobytes(), width, height, 1 if is_gray else 3, quality))
+            app.logger.debug("Encoded with mozjpeg")
+            return
+        except (subprocess.SubprocessError, OSError) as e:
+            app.logger.warning("mozjpeg failed, falling back: %s", e)
+    
+    if output_format == 'jpeg' and turbo_jpeg is not None:
+        # libjpeg-turbo's SIMD encoder works straight from the array; grayscale
+        # becomes a single-component JPEG with a third of the DCT blocks
+        f.write(turbo_jpeg.encode(
+            np.ascontiguousarray(img_array),
+            quality=quality,
+            pixel_format=TJPF_GRAY if is_gray else TJPF_RGB,
+            jpeg_subsample=TJSAMP_GRAY if is_gray else TJSAMP_420
+        ))
+    else:
+        imageio_format, takes_quality, options = IMAGEIO_ENCODERS[output_format]
+        if takes_quality:
+            options = dict(options, quality=quality)
+        imageio.imwrite(f, img_array, format=imageio_format, **options)
+
+# Worker processes for CPU-bound conversions, created on first use so that
+# importing the module (or forking server workers) does not spawn them
+_pool = None
+_pool_lock = threading.Lock()
+
+# Seconds a request waits for its conversion before giving up
+CONVERT_TIMEOUT = 30
+
+# Wall-clock deadline of the conversion running in this worker process; its
+# subprocess steps share what is left of CONVERT_TIMEOUT instead of each
+# getting the full amount, so a job the client gave up on ends promptly
+_deadline = None
+
+def _time_left():
+    """Timeout for the next subprocess step of the current conversion."""
+    if _deadline is None:
+        return CONVERT_TIMEOUT
+    return max(_deadline - time.time(), 0.01)
+
+def _run_with_deadline(deadline, fn, *args):
+    global _deadline
+    _deadline = deadline
+    try:
+        return fn(*args)
+    finally:
+        _deadline = None
+
+def _available_cpus():
+    # The affinity mask reflects container/cgroup CPU pinning; os.cpu_count() doesn't
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# gunicorn worker processes sharing this host's CPUs; gunicorn takes its
+# default --workers from the same variable
+SERVER_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Conversion processes per server process; override with CONVERT_WORKERS
+CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS', 0)) or max(1, _available_cpus() // SERVER_WORKERS)
+
+def _worker_init():
+    # Runs once per worker process: let Pillow (and so imageio) read HEIF data
+    # that was uploaded under a non-HEIC extension
+    pillow_heif.register_heif_opener()
+    # iPhone HEICs are grids of dozens of HEVC tiles; give libheif this
+    # worker's share of the cores, counting the pools of the other server
+    # workers too, so busy pools don't oversubscribe them
+    pillow_heif.options.DECODE_THREADS = max(1, _available_cpus() // (CONVERT_WORKERS * SERVER_WORKERS))
+
+def _noop():
+    pass
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # The pool is started from a request thread of a multithreaded
+            # server process; fork would copy that process mid-flight
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(
+                max_workers=CONVERT_WORKERS,
+                mp_context=multiprocessing.get_context(method),
+                initializer=_worker_init
+            )
+            # Worker processes only start as jobs arrive; one no-op each starts
+            # them all now, so the requests that follow don't wait on startup
+            for _ in range(CONVERT_WORKERS):
+                _pool.submit(_noop)
+    return _pool
+
+def _run_in_pool(fn, *args):
+    """Run ``fn(*args)`` in the conversion pool and wait up to CONVERT_TIMEOUT for the result."""
+    global _pool
+    pool = _get_pool()
+    try:
+        future = pool.submit(_run_with_deadline, time.time() + CONVERT_TIMEOUT, fn, *args)
+        try:
+            return future.result(timeout=CONVERT_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            # Drop the job if it is still queued; a running one stops at its deadline
+            future.cancel()
+            raise
+    except BrokenProcessPool:
+        # A worker died (OOM killer, crash in a native decoder); the executor
+        # cannot recover, so start a fresh one for the next request
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        pool.shutdown(wait=False)
+        raise
+
+def _sweep_uploads():
+    """Delete files in the uploads directory whose session no longer exists."""
+    cutoff = time.time() - JANITOR_INTERVAL
+    for name in os.listdir('uploads'):
+        file_path = os.path.join('uploads', name)
+        session_id = name.split('_', 1)[0]
+        # Recently touched files may belong to an upload or conversion in flight
+        try:
+            if os.path.getmtime(file_path) > cutoff or sessions.get(session_id) is not None:
+                continue
+            os.remove(file_path)
+        except OSError:
+            pass
+
+def _janitor():
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            _sweep_uploads()
+        except Exception:
+            app.logger.exception("Upload cleanup failed")
+
+# Only the serving process sweeps; conversion workers never need to
+if multiprocessing.parent_process() is None:
+    threading.Thread(target=_janitor, daemon=True).start()
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def _store_upload(filename, save):
+    """Save an upload via ``save(path)`` and register a new session for it."""
+    # Generate session ID
+    session_id = str(uuid.uuid4())
+    
+    # Save file
+    filename = secure_filename(filename)
+    file_path = os.path.join('uploads', f'{session_id}_{filename}')
+    save(file_path)
+    
+    # Store session data
+    sessions.set(session_id, {
+        'file_path': file_path,
+        'original_filename': filename,
+        'converted_path': None
+    })
+    
+    return jsonify({'session_id': session_id, 'filename': filename})
+
+def _copy_to_file(stream, file_path):
+    # Chunks larger than the file buffer go straight to write(), one syscall each
+    with open(file_path, 'wb') as f:
+        shutil.copyfileobj(stream, f, length=UPLOAD_CHUNK_SIZE)
+
+def _is_allowed_file(filename):
+    return os.path.splitext(filename.lower())[1] in ALLOWED_EXTENSIONS
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -31,145 +730,156 @@ def upload_file():
         return jsonify({'error': 'No file selected'}), 400
     
     # Validate file type
-    allowed_extensions = {'.heic', '.heif', '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
-    file_ext = os.path.splitext(file.filename.lower())[1]
-    if file_ext not in allowed_extensions:
+    if not _is_allowed_file(file.filename):
         return jsonify({'error': 'Invalid file type. Please upload an image file.'}), 400
     
-    # Generate session ID
-    session_id = str(uuid.uuid4())
+    return _store_upload(file.filename, lambda file_path: _copy_to_file(file.stream, file_path))
+
+@app.route('/upload/<filename>', methods=['PUT'])
+def upload_file_stream(filename):
+    # Raw-body upload: the request body is the file itself, so it is copied
+    # straight to disk without going through the multipart parser
+    if not _is_allowed_file(filename):
+        return jsonify({'error': 'Invalid file type. Please upload an image file.'}), 400
     
-    # Save file
-    filename = secure_filename(file.filename)
-    file_path = os.path.join('uploads', f'{session_id}_{filename}')
-    file.save(file_path)
+    return _store_upload(filename, lambda file_path: _copy_to_file(request.stream, file_path))
+
+@app.route('/convert_direct', methods=['POST'])
+def convert_direct():
+    # One-shot upload + convert: the image is decoded from the request body and
+    # the result returned in the response, with no session or files left behind
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
     
-    # Store session data
-    sessions[session_id] = {
-        'file_path': file_path,
-        'original_filename': filename,
-        'converted_path': None
-    }
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
     
-    return jsonify({'session_id': session_id, 'filename': filename})
+    if not _is_allowed_file(file.filename):
+        return jsonify({'error': 'Invalid file type. Please upload an image file.'}), 400
+    
+    quality = request.form.get('quality', DEFAULT_QUALITY, type=int)
+    output_format = request.form.get('output_format', 'jpeg')
+    if output_format not in OUTPUT_EXTENSIONS:
+        output_format = 'jpeg'
+    max_dimension = request.form.get('max_dimension', type=int)
+    if max_dimension is not None and max_dimension <= 0:
+        max_dimension = None
+    
+    try:
+        output = _run_in_pool(_convert_bytes, file.read(), file.filename, output_format, quality, max_dimension)
+    except concurrent.futures.TimeoutError:
+        app.logger.warning("Conversion timed out after %ds", CONVERT_TIMEOUT)
+        return jsonify({'error': 'Conversion timed out'}), 504
+    except Exception as e:
+        app.logger.exception("Conversion error: %s", e)
+        return jsonify({'error': 'Conversion failed'}), 500
+    
+    converted_filename = os.path.splitext(secure_filename(file.filename))[0] + OUTPUT_EXTENSIONS[output_format]
+    response = app.response_class(output, mimetype=f'image/{output_format}')
+    response.headers.set('Content-Disposition', 'attachment', filename=converted_filename)
+    return response
 
 @app.route('/convert', methods=['POST'])
 def convert_file():
     data = request.get_json()
     session_id = data.get('session_id')
-    quality = data.get('quality', 90)
+    quality = data.get('quality')
     strip_exif = data.get('strip_exif', False)
+    output_format = data.get('output_format', 'jpeg')
+    if output_format not in OUTPUT_EXTENSIONS:
+        output_format = 'jpeg'
+    inline = data.get('inline', False)
+    max_dimension = data.get('max_dimension')
+    if not isinstance(max_dimension, int) or max_dimension <= 0:
+        max_dimension = None
     
-    if session_id not in sessions:
+    session_data = sessions.get(session_id) if session_id else None
+    if session_data is None:
         return jsonify({'error': 'Invalid session ID'}), 400
     
-    session_data = sessions[session_id]
-    
     try:
-        print(f"Attempting to open file: {session_data['file_path']}")
-        print(f"File exists: {os.path.exists(session_data['file_path'])}")
-        print(f"File size: {os.path.getsize(session_data['file_path'])} bytes")
-        
-        # Try to open the image with imageio
-        img_array = None
-        open_error = None
-        
-        try:
-            # For HEIC files, try to specify format explicitly
-            if session_data['file_path'].lower().endswith(('.heic', '.heif')):
-                # Try with explicit format specification
-                img_array = imageio.imread(session_data['file_path'], format='HEIF')
-                print(f"Opened HEIC image with explicit format: shape: {img_array.shape}, dtype: {img_array.dtype}")
-            else:
-                # For other formats, use default imageio
-                img_array = imageio.imread(session_data['file_path'])
-                print(f"Opened image with imageio: shape: {img_array.shape}, dtype: {img_array.dtype}")
-        except Exception as e:
-            print(f"Failed to open with imageio: {e}")
-            open_error = e
-            
-            # Try alternative approach for HEIC files
-            if session_data['file_path'].lower().endswith(('.heic', '.heif')):
-                try:
-                    # Try without format specification
-                    img_array = imageio.imread(session_data['file_path'])
-                    print(f"Opened HEIC image without format spec: shape: {img_array.shape}, dtype: {img_array.dtype}")
-                except Exception as e2:
-                    print(f"Failed alternative HEIC approach: {e2}")
-                    raise open_error
-            else:
-                raise open_error
-        
-        if img_array is None:
-            raise open_error
-        
-        # Convert to RGB if necessary
-        if len(img_array.shape) == 3 and img_array.shape[2] == 4:
-            # RGBA to RGB with white background
-            rgb_array = np.zeros((img_array.shape[0], img_array.shape[1], 3), dtype=img_array.dtype)
-            alpha = img_array[:, :, 3:4] / 255.0
-            rgb_array = img_array[:, :, :3] * alpha + (1 - alpha) * 255
-            img_array = rgb_array.astype(np.uint8)
-            print(f"Converted RGBA to RGB")
-        elif len(img_array.shape) == 2:
-            # Grayscale to RGB
-            img_array = np.stack([img_array] * 3, axis=-1)
-            print(f"Converted grayscale to RGB")
-        
-        # Prepare output
-        output_buffer = io.BytesIO()
-        
-        # Save as JPEG using imageio
-        imageio.imwrite(output_buffer, img_array, format='JPEG', quality=quality)
-        output_buffer.seek(0)
-        
         # Save converted file
-        converted_filename = os.path.splitext(session_data['original_filename'])[0] + '.jpg'
-        converted_path = os.path.join('uploads', f'{session_id}_{converted_filename}')
+        converted_filename = os.path.splitext(session_data['original_filename'])[0] + OUTPUT_EXTENSIONS[output_format]
+        # Distinct from the upload path, which a same-format conversion would otherwise overwrite mid-read
+        converted_path = os.path.join('uploads', f'{session_id}_converted_{converted_filename}')
         
-        with open(converted_path, 'wb') as f:
-            f.write(output_buffer.getvalue())
+        # Decode/encode is CPU-bound, so it runs in the process pool rather than the request thread
+        file_size = _run_in_pool(
+            _do_convert, session_data['file_path'], converted_path, output_format, quality, strip_exif, max_dimension
+        )
         
         # Update session data
         session_data['converted_path'] = converted_path
+        sessions.set(session_id, session_data)
         
-        print(f"Conversion completed successfully: {len(output_buffer.getvalue())} bytes")
-        print("Returning success response")
+        app.logger.debug("Conversion completed successfully: %d bytes", file_size)
+        
+        if inline:
+            # Hand the image back in this response so the client needs no /download round-trip
+            return send_file(
+                converted_path,
+                mimetype=f'image/{output_format}',
+                as_attachment=True,
+                download_name=converted_filename
+            )
         
         return jsonify({
             'success': True,
             'session_id': session_id,
             'converted_filename': converted_filename,
-            'file_size': len(output_buffer.getvalue())
+            'output_format': output_format,
+            'file_size': file_size
         })
         
+    except concurrent.futures.TimeoutError:
+        app.logger.warning("Conversion timed out after %ds", CONVERT_TIMEOUT)
+        return jsonify({'error': 'Conversion timed out'}), 504
+        
     except Exception as e:
-        print(f"Conversion error: {e}")
-        import traceback
-        traceback.print_exc()
+        app.logger.exception("Conversion error: %s", e)
         return jsonify({'error': 'Conversion failed'}), 500
 
 @app.route('/download/<session_id>')
 def download_file(session_id):
-    if session_id not in sessions:
+    session_data = sessions.get(session_id)
+    if session_data is None:
         return jsonify({'error': 'Invalid session ID'}), 404
     
-    session_data = sessions[session_id]
-    if not session_data.get('converted_path') or not os.path.exists(session_data['converted_path']):
+    converted_path = session_data.get('converted_path')
+    if not converted_path:
         return jsonify({'error': 'Converted file not found'}), 404
     
-    return send_file(
-        session_data['converted_path'],
-        as_attachment=True,
-        download_name=os.path.basename(session_data['converted_path'])
-    )
+    filename = os.path.basename(converted_path)
+    download_name = os.path.splitext(session_data['original_filename'])[0] + os.path.splitext(converted_path)[1]
+    
+    if ACCEL_REDIRECT_PREFIX:
+        # Leave the bytes (and a missing file's 404) entirely to nginx
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + filename
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        return response
+    
+    # Serve from the filesystem path so the WSGI server can use its file
+    # wrapper (sendfile) and answer Range / If-None-Match requests itself;
+    # the open doubles as the existence check
+    try:
+        return send_from_directory(
+            'uploads',
+            filename,
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True
+        )
+    except NotFound:
+        return jsonify({'error': 'Converted file not found'}), 404
 
 @app.route('/status/<session_id>')
 def get_status(session_id):
-    if session_id not in sessions:
+    session_data = sessions.get(session_id)
+    if session_data is None:
         return jsonify({'error': 'Invalid session ID'}), 404
     
-    session_data = sessions[session_id]
     return jsonify({
         'session_id': session_id,
         'original_filename': session_data['original_filename'],
@@ -178,8 +888,8 @@ def get_status(session_id):
 
 @app.route('/clear/<session_id>', methods=['DELETE'])
 def clear_session(session_id):
-    if session_id in sessions:
-        session_data = sessions[session_id]
+    session_data = sessions.get(session_id)
+    if session_data is not None:
         
         # Clean up files
         for file_path in [session_data['file_path'], session_data.get('converted_path')]:
@@ -190,7 +900,7 @@ def clear_session(session_id):
                     pass
         
         # Remove session
-        del sessions[session_id]
+        sessions.delete(session_id)
     
     return jsonify({'success': True})
 
@@ -204,4 +914,7 @@ def robots():
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
+    # Start the conversion workers before serving the first request; under
+    # gunicorn, gunicorn.conf.py does the same for each server worker
+    _get_pool()
     app.run(host='0.0.0.0', port=port, debug=False) 
\ No newline at end of file
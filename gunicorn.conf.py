@@ -0,0 +1,8 @@
+# gunicorn reads this file from the working directory; command-line options
+# (Procfile, render.yaml) still take precedence over anything set here
+
+def post_worker_init(worker):
+    # Start this server worker's conversion processes before it takes requests,
+    # instead of on its first conversion
+    from app import _get_pool
+    _get_pool()
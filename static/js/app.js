@@ -136,13 +136,13 @@ async function uploadFiles(fileList) {
         updateUI();
         
         try {
-            // Upload file
-            const formData = new FormData();
-            formData.append('file', file);
-            
-            const uploadResponse = await fetch('/upload', {
-                method: 'POST',
-                body: formData
+            // Upload file as the raw request body
+            const uploadResponse = await fetch(`/upload/${encodeURIComponent(file.name)}`, {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'application/octet-stream'
+                },
+                body: file
             });
             
             if (!uploadResponse.ok) {
@@ -179,7 +179,8 @@ async function convertFile(fileData) {
         const convertData = {
             session_id: fileData.sessionId,
             strip_exif: stripExif.checked,
-            output_format: outputFormat.value
+            output_format: outputFormat.value,
+            inline: true
         };
         
         const convertResponse = await fetch('/convert', {
@@ -194,10 +195,12 @@ async function convertFile(fileData) {
             throw new Error('Conversion failed');
         }
         
-        const convertResult = await convertResponse.json();
+        // The converted image comes back in the response body
+        const convertedBlob = await convertResponse.blob();
+        fileData.downloadUrl = URL.createObjectURL(convertedBlob);
         fileData.status = 'completed';
         fileData.progress = 100;
-        fileData.outputFormat = convertResult.output_format;
+        fileData.outputFormat = convertData.output_format;
         updateUI();
         
     } catch (error) {
@@ -212,7 +215,7 @@ function downloadFile(fileData) {
         return;
     }
     
-    const downloadUrl = `/download/${fileData.sessionId}`;
+    const downloadUrl = fileData.downloadUrl || `/download/${fileData.sessionId}`;
     const link = document.createElement('a');
     link.href = downloadUrl;
     link.download = getOutputFileName(fileData.fileName, fileData.outputFormat);
@@ -245,6 +248,9 @@ function clearAllFiles() {
         if (file.sessionId) {
             fetch(`/clear/${file.sessionId}`, { method: 'DELETE' }).catch(() => {});
         }
+        if (file.downloadUrl) {
+            URL.revokeObjectURL(file.downloadUrl);
+        }
     });
     
     files = [];